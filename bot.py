@@ -1,32 +1,64 @@
 import logging
 import csv
+import atexit
 import asyncio
-from aiogram import Bot, Dispatcher, types
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import signal
+import re
+import sys
+from aiogram import Bot, Dispatcher, F, Router, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 import gspread
 from gspread.exceptions import APIError
-from oauth2client.service_account import ServiceAccountCredentials
+from google.auth.exceptions import GoogleAuthError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util import Retry
 import time
+from array import array
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 import os
 import base64
-import json
+import orjson
+
+try:
+    import uvloop
+except ImportError:  # uvloop doesn't support Windows
+    uvloop = None
+
+load_dotenv()
 
 # Configure logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# getLevelName returns the numeric level for known names and a "Level X" string otherwise
+LOG_LEVEL_KNOWN = isinstance(logging.getLevelName(LOG_LEVEL), int)
 logging.basicConfig(
-    level=logging.INFO,
+    level=LOG_LEVEL if LOG_LEVEL_KNOWN else logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
-
-load_dotenv()
+if not LOG_LEVEL_KNOWN:
+    logger.warning("⚠️ Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 USE_GOOGLE_SHEETS = True
 GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME")
 SURVEY_EXPIRY_TIME = 180  # 3 minutes
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
+# When set, Telegram pushes updates to WEBHOOK_URL + WEBHOOK_PATH instead of being polled
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/wh"
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; requests without it are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8080"))
 
 # Validate critical environment variables
 if not BOT_TOKEN:
@@ -35,73 +67,124 @@ if not GOOGLE_CREDENTIALS_JSON:
     raise ValueError("GOOGLE_CREDENTIALS_JSON is missing! Set it in Railway Variables.")
 if not GOOGLE_SHEET_NAME:
     raise ValueError("GOOGLE_SHEET_NAME is missing! Set it in Railway Variables.")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET is missing! Set it in Railway Variables when using WEBHOOK_URL.")
 
-print("✅ Environment variables validated")
+logger.info("✅ Environment variables validated")
 
-# Improved Google Credentials Handling
-try:
-    if GOOGLE_CREDENTIALS_JSON and isinstance(GOOGLE_CREDENTIALS_JSON, str):
-        if GOOGLE_CREDENTIALS_JSON.strip().startswith('{'):
-            credentials_json = json.loads(GOOGLE_CREDENTIALS_JSON)
+def get_credentials() -> dict:
+    # Improved Google Credentials Handling
+    try:
+        if GOOGLE_CREDENTIALS_JSON and isinstance(GOOGLE_CREDENTIALS_JSON, str):
+            raw = GOOGLE_CREDENTIALS_JSON.encode()
+            # Raw JSON starts with '{'; anything else is treated as base64
+            if raw.lstrip()[:1] == b'{':
+                credentials_json = orjson.loads(raw)
+            else:
+                credentials_json = orjson.loads(base64.b64decode(raw))
         else:
-            decoded = base64.b64decode(GOOGLE_CREDENTIALS_JSON)
-            credentials_json = json.loads(decoded.decode('utf-8'))
-    else:
-        raise ValueError("GOOGLE_CREDENTIALS_JSON is empty or invalid")
+            raise ValueError("GOOGLE_CREDENTIALS_JSON is empty or invalid")
 
-    print("✅ Google credentials successfully loaded")
-except Exception as e:
-    logging.error(f"❌ Failed to load Google credentials: {str(e)}")
-    raise
+        logger.info("✅ Google credentials successfully loaded")
+        return credentials_json
+    except Exception as e:
+        logger.error("❌ Failed to load Google credentials: %s", e)
+        raise
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+class SheetsRetry(Retry):
+    # POSTs (values:append, values:batchUpdate) may already have been applied after a
+    # timeout or 5xx, and repeating an append duplicates rows. Only a 429 is known to be
+    # rejected, so that is the one status POSTs are retried on; urllib3's default
+    # allowed_methods already keeps POST read errors from being retried. Anything else
+    # falls through to the flusher's failed_writes retry.
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "POST":
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+def get_sheet(credentials_json):
+    scope = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive"
+    ]
+    client = gspread.service_account_from_dict(credentials_json, scopes=scope)
+    # Keep connections to sheets.googleapis.com alive across calls and back off on
+    # rate limits and transient server errors
+    retries = SheetsRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
+    client.http_client.session.mount(
+        "https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries)
+    )
+    # Only Sheets/Drive calls use this adapter: AuthorizedSession refreshes tokens over its
+    # own internal requests.Session (with google-auth's 3-retry adapter), not this one
 
-if USE_GOOGLE_SHEETS:
     try:
-        scope = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(credentials_json, scope)
-        client = gspread.authorize(creds)
-
+        spreadsheet = client.open(GOOGLE_SHEET_NAME)
+        logger.info("📊 Found spreadsheet by name: %s", GOOGLE_SHEET_NAME)
+    except gspread.SpreadsheetNotFound:
         try:
-            spreadsheet = client.open(GOOGLE_SHEET_NAME)
-            print(f"📊 Found spreadsheet by name: {GOOGLE_SHEET_NAME}")
-        except gspread.SpreadsheetNotFound:
-            try:
-                SPREADSHEET_URL = os.getenv("SPREADSHEET_URL")
-                if SPREADSHEET_URL:
-                    spreadsheet = client.open_by_url(SPREADSHEET_URL)
-                    print(f"🔗 Found spreadsheet by URL: {SPREADSHEET_URL}")
-                else:
-                    spreadsheet = client.create(GOOGLE_SHEET_NAME)
-                    spreadsheet.share(credentials_json['client_email'], perm_type='user', role='writer')
-                    print(f"🆕 Created new spreadsheet: {GOOGLE_SHEET_NAME}")
-            except Exception as e:
-                raise Exception(f"All spreadsheet access methods failed: {str(e)}")
-
-        try:
-            sheet = spreadsheet.sheet1
-            print(f"📑 Using first worksheet: {sheet.title}")
+            SPREADSHEET_URL = os.getenv("SPREADSHEET_URL")
+            if SPREADSHEET_URL:
+                spreadsheet = client.open_by_url(SPREADSHEET_URL)
+                logger.info("🔗 Found spreadsheet by URL: %s", SPREADSHEET_URL)
+            else:
+                spreadsheet = client.create(GOOGLE_SHEET_NAME)
+                spreadsheet.share(credentials_json['client_email'], perm_type='user', role='writer')
+                logger.info("🆕 Created new spreadsheet: %s", GOOGLE_SHEET_NAME)
         except Exception as e:
-            raise Exception(f"Worksheet access failed: {str(e)}")
+            raise Exception(f"All spreadsheet access methods failed: {str(e)}")
 
+    try:
+        sheet = spreadsheet.sheet1
+        logger.info("📑 Using first worksheet: %s", sheet.title)
     except Exception as e:
-        logging.error("❌ Critical Google Sheets setup error!")
-        logging.error(f"Error details: {str(e)}")
+        raise Exception(f"Worksheet access failed: {str(e)}")
+
+    return spreadsheet, sheet
+
+credentials_json = get_credentials()
+
+bot = Bot(token=BOT_TOKEN)
+router = Router()
+
+if USE_GOOGLE_SHEETS:
+    try:
+        spreadsheet, sheet = get_sheet(credentials_json)
+    except Exception as e:
+        logger.error("❌ Critical Google Sheets setup error!")
+        logger.error("Error details: %s", e)
         if hasattr(e, 'response'):
-            logging.error(f"API response: {e.response.text}")
+            logger.error("API response: %s", e.response.text)
 
         USE_GOOGLE_SHEETS = False
-        logging.warning("⚠️ Falling back to CSV storage")
+        logger.warning("⚠️ Falling back to CSV storage")
         with open("emergency_fallback.csv", "w") as f:
             f.write("timestamp,error_details\n")
             f.write(f"{time.time()},{str(e)}\n")
         raise
 
 CSV_FILE = "responses.csv"
+# Opened once in main() when writing to CSV; rows go into a 64 KiB buffer
+csv_file = None
+csv_writer = None
+
+# Maps user ID (Column A) to its sheet row so saves never have to scan the sheet
+row_index = {}
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-run
+background_tasks = set()
+
+# Completed responses waiting to be written to the sheet in one batch
+pending_writes = asyncio.Queue()
+# Put on pending_writes by main() at shutdown; the flusher writes what it holds and exits
+STOP_FLUSHER = None
+# Rows from a failed flush, retried ahead of anything newer in the queue
+failed_writes = {}
+BATCH_FLUSH_INTERVAL = 5  # seconds
+MAX_BATCH = 50
 
 questions = [
     "The closer I am to a major exam, the harder it is for me to concentrate on the material.",
@@ -115,173 +198,456 @@ questions = [
     "After an exam, I worry about whether I did well enough.",
     "I struggle with writing assignments, or avoid them as long as I can. I feel that whatever I do will not be good enough."
 ]
+Q_TEXTS = tuple(f"Q{i+1}: {q}" for i, q in enumerate(questions))
+
+
+@dataclass(slots=True)
+class Session:
+    start_time: float = 0.0  # wall clock, only used for the completion-time column
+    deadline: float = 0.0  # time.monotonic() after which the session has expired
+    age: int = -1  # -1 until the user has entered an age
+    sex: str = ""
+    # One signed byte per question: -1 until answered, then the rating 1..5
+    responses: array = field(default_factory=lambda: array("b", [-1] * len(questions)))
+    answered: int = 0
+    msg_id: int = 0  # message the questions are edited into
+
+class SurveyStates(StatesGroup):
+    # Lets the router skip handlers for users who aren't at that step
+    awaiting_age = State()
+    awaiting_sex = State()
+    answering = State()
+
+def expired(session) -> bool:
+    return time.monotonic() > session.deadline
+
+def live_session(user_id):
+    # The user's session, or None (dropping it) if it's missing or expired
+    session = user_responses.get(user_id)
+    if session is not None and expired(session):
+        del user_responses[user_id]
+        return None
+    return session
+
+EXPIRED_MSG = "Your session has expired. Please restart with /start."
+
 user_responses = {}
+# Users who blocked the bot; skipped by expiry notices until they /start again
+blocked_users = set()
+# (deadline, user_id) min-heap so cleanup only looks at sessions that are due
+expiry_heap = []
+
+# Accepted callback data and age input
+# Rating buttons carry "<question index>:<rating>" so a tap can be matched to its question
+RATING_CALLBACKS = {f"{q}:{r}": (q, r) for q in range(len(questions)) for r in range(1, 6)}
+RATINGS = frozenset(RATING_CALLBACKS)
+SEXES = frozenset({"male", "female", "other"})
+AGE_RE = re.compile(r"\d{1,3}", re.ASCII)
+
+# Keyboards never change, so build them once and reuse them for every message
+RATING_KEYBOARDS = tuple(
+    InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=str(r), callback_data=f"{q}:{r}") for r in range(5, 0, -1)]
+    ])
+    for q in range(len(questions))
+)
+BEGIN_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="▶️ BEGIN SURVEY", callback_data="start_survey")]
+])
+SEX_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Male", callback_data="male"),
+     InlineKeyboardButton(text="Female", callback_data="female"),
+     InlineKeyboardButton(text="Other", callback_data="other")]
+])
+
+INTRO_TEXT = (
+    "🤖 **Welcome to the Test Anxiety Bot!**\n\n"
+    "This bot will ask you a series of questions about test anxiety. "
+    "Please rate how true each statement is for you using the following **5-point scale**:\n\n"
+    "```\n"
+    "  5️⃣  Extremely or always true\n"
+    "  4️⃣  Highly or usually true\n"
+    "  3️⃣  Moderately or sometimes true\n"
+    "  2️⃣  Slightly or seldom true\n"
+    "  1️⃣  Not at all or never true\n"
+    "```\n"
+    "**📌 Commands:**\n"
+    "🔹 `/start` - Begin the survey\n"
+    "🔹 `/help` - Show this help message\n\n"
+    "**📋 How it works:**\n"
+    "1️⃣ The bot will ask a series of statements about test anxiety.\n"
+    "2️⃣ You will rate each statement based on the 5-point scale above.\n"
+    "3️⃣ Your responses are completely **anonymous** and stored securely.\n\n"
+    "Thank you for participating! 😊\n"
+    "👉 **Start the survey now:** /start"
+)
 
-def create_rating_keyboard():
-    buttons = [InlineKeyboardButton(text=str(i), callback_data=str(i)) for i in range(5, 0, -1)]
-    return InlineKeyboardMarkup(inline_keyboard=[buttons])
-
-def get_intro_text() -> str:
-    return (
-        "🤖 **Welcome to the Test Anxiety Bot!**\n\n"
-        "This bot will ask you a series of questions about test anxiety. "
-        "Please rate how true each statement is for you using the following **5-point scale**:\n\n"
-        "```\n"
-        "  5️⃣  Extremely or always true\n"
-        "  4️⃣  Highly or usually true\n"
-        "  3️⃣  Moderately or sometimes true\n"
-        "  2️⃣  Slightly or seldom true\n"
-        "  1️⃣  Not at all or never true\n"
-        "```\n"
-        "**📌 Commands:**\n"
-        "🔹 `/start` - Begin the survey\n"
-        "🔹 `/help` - Show this help message\n\n"
-        "**📋 How it works:**\n"
-        "1️⃣ The bot will ask a series of statements about test anxiety.\n"
-        "2️⃣ You will rate each statement based on the 5-point scale above.\n"
-        "3️⃣ Your responses are completely **anonymous** and stored securely.\n\n"
-        "Thank you for participating! 😊\n"
-        "👉 **Start the survey now:** /start"
-    )
+
+async def run_concurrently(*aws):
+    # Unlike a bare gather, let every request finish and log each failure
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Telegram request failed: %s", result)
+    return results
 
 
-@dp.message(Command("start"))
-async def start(message: types.Message):
+@router.message(Command("start"))
+async def start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user_responses[user_id] = {"responses": [], "start_time": time.time()}
+    session = Session(start_time=time.time(), deadline=time.monotonic() + SURVEY_EXPIRY_TIME)
+    user_responses[user_id] = session
+    heapq.heappush(expiry_heap, (session.deadline, user_id))
+    blocked_users.discard(user_id)
+    await state.set_state(SurveyStates.awaiting_age)
 
     await message.answer(
-        get_intro_text(),
+        INTRO_TEXT,
         parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="▶️ BEGIN SURVEY", callback_data="start_survey")]
-        ])
+        reply_markup=BEGIN_KEYBOARD
     )
 
-@dp.callback_query(lambda call: call.data == "start_survey")
+@router.callback_query(F.data == "start_survey")
 async def start_survey(call: types.CallbackQuery):
     await call.answer()
     await call.message.delete()  # Clean up the button message
     await call.message.answer("First, please tell me your age:")
 
-@dp.message(Command("help"))
+@router.message(Command("help"))
 async def help_command(message: types.Message):
-    await message.answer(get_intro_text(), parse_mode="Markdown")
+    await message.answer(INTRO_TEXT, parse_mode="Markdown")
 
 
-@dp.message()
-async def handle_age(message: types.Message):
+@router.message(SurveyStates.awaiting_age)
+async def handle_age(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if user_id in user_responses and "age" not in user_responses[user_id]:
-        if message.text.isdigit():
-            user_responses[user_id]["age"] = int(message.text)
-            await message.answer("Please select your sex:", reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[ 
-                    [InlineKeyboardButton(text="Male", callback_data="male"),
-                     InlineKeyboardButton(text="Female", callback_data="female"),
-                     InlineKeyboardButton(text="Other", callback_data="other")]
-                ]
-            ))
-        else:
-            await message.answer("Invalid input. Please enter a valid age:")
+    if user_id not in user_responses:
+        # Session was cleaned up while waiting for the age
+        await state.clear()
+        return
+    if message.text and AGE_RE.fullmatch(message.text):
+        user_responses[user_id].age = int(message.text)
+        await state.set_state(SurveyStates.awaiting_sex)
+        await message.answer("Please select your sex:", reply_markup=SEX_KEYBOARD)
+    else:
+        await message.answer("Invalid input. Please enter a valid age:")
 
-@dp.callback_query(lambda call: call.data in ["male", "female", "other"])
-async def handle_sex(call: types.CallbackQuery):
+@router.callback_query(SurveyStates.awaiting_sex, F.data.in_(SEXES))
+async def handle_sex(call: types.CallbackQuery, state: FSMContext):
     user_id = call.from_user.id
-    user_responses[user_id]["sex"] = call.data
-    await call.answer()
-    await call.message.answer("Thank you! Now let's start the test.")
+    session = live_session(user_id)
+    if session is None:
+        await state.clear()
+        await call.answer(EXPIRED_MSG)
+        return
+    session.sex = sys.intern(call.data)  # share one str across sessions
+    await state.set_state(SurveyStates.answering)
+    await run_concurrently(call.answer(), call.message.answer("Thank you! Now let's start the test."))
     await ask_question(user_id, 0)
 
 async def ask_question(user_id, index):
-    if user_id not in user_responses or time.time() - user_responses[user_id]["start_time"] > SURVEY_EXPIRY_TIME:
-        user_responses.pop(user_id, None)
-        await bot.send_message(user_id, "Your session has expired. Please restart with /start.")
+    session = live_session(user_id)
+    if session is None:
+        await bot.send_message(user_id, EXPIRED_MSG)
         return
 
     if index < len(questions):
-        await bot.send_message(user_id, f"Q{index+1}: {questions[index]}", reply_markup=create_rating_keyboard())
+        # Later questions are edited into this message by handle_response
+        message = await bot.send_message(user_id, Q_TEXTS[index], reply_markup=RATING_KEYBOARDS[index])
+        session.msg_id = message.message_id
     else:
         await save_response(user_id)
 
-@dp.callback_query(lambda call: call.data in ["1", "2", "3", "4", "5"])
-async def handle_response(call: types.CallbackQuery):
+@router.callback_query(SurveyStates.answering, F.data.in_(RATINGS))
+async def handle_response(call: types.CallbackQuery, state: FSMContext):
     user_id = call.from_user.id
-    if user_id not in user_responses or time.time() - user_responses[user_id]["start_time"] > SURVEY_EXPIRY_TIME:
-        user_responses.pop(user_id, None)
-        await call.answer("Your session has expired. Please restart with /start.")
+    session = live_session(user_id)
+    if session is None:
+        await state.clear()
+        await call.answer(EXPIRED_MSG)
+        return
+    question, rating = RATING_CALLBACKS[call.data]
+    if call.message.message_id != session.msg_id or question != session.answered:
+        # Button on an older survey message, or a repeated tap on a question that was
+        # already answered (e.g. a double tap before the edit reached the client)
+        await call.answer()
         return
 
-    user_responses[user_id]["responses"].append(call.data)
-    await call.answer()
-    if len(user_responses[user_id]["responses"]) < len(questions):
-        await ask_question(user_id, len(user_responses[user_id]["responses"]))
+    session.responses[question] = rating
+    session.answered = index = question + 1
+    # Acknowledge the button press while the next request is in flight
+    if index < len(questions):
+        _, edited = await run_concurrently(
+            call.answer(), call.message.edit_text(Q_TEXTS[index], reply_markup=RATING_KEYBOARDS[index])
+        )
+        if isinstance(edited, Exception):
+            # The user still sees this question, so let them answer it again
+            session.answered = question
     else:
-        await save_response(user_id)
+        await state.clear()
+        await run_concurrently(call.answer(), save_response(user_id))
+
+
+def appended_row(result) -> int:
+    # append_row/append_rows return e.g. {"updates": {"updatedRange": "Sheet1!A5:N5"}}
+    updated_range = result["updates"]["updatedRange"]
+    return gspread.utils.a1_to_rowcol(updated_range.split("!")[-1].split(":")[0])[0]
+
+async def load_row_index():
+    user_ids = await asyncio.to_thread(sheet.col_values, 1)
+    # Blank cells in column A don't belong to anyone
+    row_index.update({uid: i + 1 for i, uid in enumerate(user_ids) if uid})
+    logger.info("📇 Indexed %d existing rows", len(row_index))
+
+
+async def write_batch(batch) -> bool:
+    updates = [(row_index[uid], data) for uid, data in batch.items() if uid in row_index]
+    new_rows = [(uid, data) for uid, data in batch.items() if uid not in row_index]
+    try:
+        if updates:
+            # One batchUpdate for every user that already has a row
+            body = {
+                "valueInputOption": "RAW",
+                "data": [
+                    {"range": gspread.utils.absolute_range_name(sheet.title, f"A{row}:N{row}"), "values": [data]}
+                    for row, data in updates
+                ]
+            }
+            await asyncio.to_thread(spreadsheet.values_batch_update, body)
+        if new_rows:
+            # One append for every new user; rows land contiguously
+            result = await asyncio.to_thread(
+                sheet.append_rows,
+                [data for _, data in new_rows],
+                value_input_option="RAW",
+                insert_data_option="INSERT_ROWS"
+            )
+            first_row = appended_row(result)
+            for offset, (uid, _) in enumerate(new_rows):
+                row_index[uid] = first_row + offset
+        logger.info(
+            "Flushed %d responses to Google Sheets (%d updated, %d added)", len(batch), len(updates), len(new_rows)
+        )
+        return True
+    except (APIError, RequestException, GoogleAuthError) as e:
+        logger.error("API error while flushing responses, retrying %d on next flush: %s", len(batch), e)
+        failed_writes.update(batch)
+        return False
+
+async def flush_sheet_writer():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        # Keyed by user ID so a repeated submission only keeps the latest row
+        batch = dict(failed_writes)
+        failed_writes.clear()
+        if not batch:
+            # Idle until a response arrives instead of waking up on a timer
+            item = await pending_writes.get()
+            if item is STOP_FLUSHER:
+                stopping = True
+            else:
+                user_id, response_data = item
+                batch[str(user_id)] = response_data
+
+        # Flush once MAX_BATCH users are collected or BATCH_FLUSH_INTERVAL has passed
+        deadline = loop.time() + BATCH_FLUSH_INTERVAL
+        while not stopping and len(batch) < MAX_BATCH:
+            try:
+                item = await asyncio.wait_for(pending_writes.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if item is STOP_FLUSHER:
+                stopping = True
+                break
+            user_id, response_data = item
+            batch[str(user_id)] = response_data
+
+        if stopping:
+            # Shutting down: everything still queued goes out in this last batch
+            while not pending_writes.empty():
+                item = pending_writes.get_nowait()
+                if item is not STOP_FLUSHER:
+                    user_id, response_data = item
+                    batch[str(user_id)] = response_data
+            if not batch:
+                break
+
+        try:
+            written = await write_batch(batch)
+        except Exception:
+            # Last resort: keep the flusher alive and the rows queued whatever went wrong
+            logger.exception("Unexpected error while flushing responses, retrying %d on next flush", len(batch))
+            failed_writes.update(batch)
+            written = False
+        if not written and not stopping:
+            await asyncio.sleep(BATCH_FLUSH_INTERVAL)
+
+    if failed_writes:
+        logger.error("❌ Shutting down with %d responses that could not be saved", len(failed_writes))
+
+
+def log_task_exit(task):
+    # Long-running tasks should never finish; make it loud if one does
+    if task.cancelled():
+        return
+    if task.exception():
+        logger.error("Background task %s stopped", task.get_name(), exc_info=task.exception())
+    else:
+        logger.error("Background task %s exited unexpectedly", task.get_name())
+
+
+async def persist_response(user_id, response_data):
+    try:
+        if USE_GOOGLE_SHEETS:
+            # Picked up by flush_sheet_writer in its next batch
+            pending_writes.put_nowait((user_id, response_data))
+        else:
+            csv_writer.writerow(response_data)
+    except Exception as e:
+        logger.error("Failed to save response for user %s: %s", user_id, e)
 
 
 async def save_response(user_id):
-    if user_id not in user_responses or time.time() - user_responses[user_id]["start_time"] > SURVEY_EXPIRY_TIME:
-        user_responses.pop(user_id, None)
-        await bot.send_message(user_id, "Your session has expired. Please restart with /start.")
+    session = live_session(user_id)
+    if session is None:
+        await bot.send_message(user_id, EXPIRED_MSG)
         return
 
-    completion_time = time.time() - user_responses[user_id]["start_time"]
+    completion_time = time.time() - session.start_time
     response_data = [
         str(user_id),
-        str(user_responses[user_id].get("age", "N/A")),
-        str(user_responses[user_id].get("sex", "N/A"))
-    ] + user_responses[user_id]["responses"] + [str(completion_time)]
+        str(session.age) if session.age >= 0 else "N/A",
+        session.sex or "N/A",
+        *map(str, session.responses),
+        f"{completion_time:.3f}"
+    ]
 
     # Ensure response fits A-N (14 columns max)
     response_data = response_data[:14]
 
-    print(f"Saving response for user {user_id}: {response_data}")  # Add debug log
-
-    if USE_GOOGLE_SHEETS:
-        try:
-            # Find the row by user ID (Column A)
-            cell = sheet.find(str(user_id))
-            if cell:
-                # Update existing row if user ID is found
-                sheet.update(range_name=f"A{cell.row}:N{cell.row}", values=[response_data])
-                print(f"Updated existing entry for user {user_id}")
-            else:
-                # Append new row if user ID is not found
-                sheet.append_row(response_data)
-                print(f"Added new entry for user {user_id}")
-        except APIError as e:
-            print(f"API error while saving response: {e}")
-            sheet.append_row(response_data)
-    else:
-        with open(CSV_FILE, mode="a", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(response_data)
+    logger.debug("Saving response for user %s: %s", user_id, response_data)
 
     del user_responses[user_id]
+    # Don't make the user wait on storage for their confirmation
+    task = asyncio.create_task(persist_response(user_id, response_data))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
     await bot.send_message(user_id, "Thank you for completing the test! Your responses have been saved.")
 
 
-async def cleanup_expired_sessions():
+async def notify_expired(user_id):
+    if user_id in blocked_users:
+        return
     while True:
-        current_time = time.time()
-        expired_users = [user_id for user_id, data in user_responses.items() if current_time - data["start_time"] > SURVEY_EXPIRY_TIME]
+        try:
+            await bot.send_message(user_id, EXPIRED_MSG)
+            return
+        except TelegramRetryAfter as e:
+            # Flood control: wait as long as Telegram asks, then try again
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            blocked_users.add(user_id)
+            return
+        except TelegramAPIError as e:
+            logger.warning("Could not notify user %s of expiry: %s", user_id, e)
+            return
 
-        for user_id in expired_users:
-            del user_responses[user_id]
-            try:
-                await bot.send_message(user_id, "Your session has expired. Please restart with /start.")
-            except Exception:
-                pass
+async def cleanup_expired_sessions():
+    while True:
+        current_time = time.monotonic()
+        expired_users = []
+        while expiry_heap and expiry_heap[0][0] < current_time:
+            _, user_id = heapq.heappop(expiry_heap)
+            # Skip entries for sessions that finished or were restarted with /start
+            session = user_responses.get(user_id)
+            if session and current_time > session.deadline:
+                del user_responses[user_id]
+                expired_users.append(user_id)
+
+        # Notify everyone at once; an unexpected error must not stop the cleanup loop
+        results = await asyncio.gather(*(notify_expired(user_id) for user_id in expired_users), return_exceptions=True)
+        for user_id, result in zip(expired_users, results):
+            if result is not None:
+                logger.error("Could not notify user %s of expiry: %r", user_id, result)
+
+        if csv_file:
+            await asyncio.to_thread(csv_file.flush)
+
+        # Wake up for the next expiry, but at least every 10 seconds
+        await asyncio.sleep(min(10, expiry_heap[0][0] - time.monotonic()) if expiry_heap else 10)
+
+def build_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+async def run_webhook(dp):
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        allowed_updates=dp.resolve_used_update_types(),
+        secret_token=WEBHOOK_SECRET
+    )
 
-        await asyncio.sleep(10)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=PORT).start()
+    logger.info("🌐 Listening for webhook updates on port %d", PORT)
+    # Stop on SIGTERM (redeploys) so main() can flush queued responses
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
 
 async def main():
-    asyncio.create_task(cleanup_expired_sessions())
+    global csv_file, csv_writer
+    flusher_task = None
+    dp = build_dispatcher()
+    # Bounded pool for the blocking gspread and file calls run via asyncio.to_thread
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=8))
+    if USE_GOOGLE_SHEETS:
+        await load_row_index()
+        flusher_task = asyncio.create_task(flush_sheet_writer(), name="flush_sheet_writer")
+        flusher_task.add_done_callback(log_task_exit)
+    else:
+        csv_file = open(CSV_FILE, mode="a", newline="", buffering=1 << 16)
+        csv_writer = csv.writer(csv_file)
+        atexit.register(csv_file.close)
+    cleanup_task = asyncio.create_task(cleanup_expired_sessions(), name="cleanup_expired_sessions")
+    cleanup_task.add_done_callback(log_task_exit)
     try:
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook(dp)
+        else:
+            # getUpdates is rejected while a webhook is registered
+            await bot.delete_webhook()
+            # Only ask for the update types our handlers use, and hold each getUpdates open for 30 s
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(), polling_timeout=30)
     except Exception as e:
-        logging.error(f"Error occurred: {e}")
+        logger.error("Error occurred: %s", e)
+    finally:
+        # Saves are fire-and-forget, so finish them before exiting
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        if flusher_task:
+            # Let the flusher write its current batch and the rest of the queue itself, so
+            # rows are never written from two places at once
+            flusher_task.remove_done_callback(log_task_exit)
+            pending_writes.put_nowait(STOP_FLUSHER)
+            await asyncio.gather(flusher_task, return_exceptions=True)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())